@@ -1,74 +1,134 @@
+import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
+# Columns of the S3 premium sheet used by the comparison.
+S3_COLUMNS = {'year', 'insurer', 'type', 'policy number', 'total premium'}
+# Workbook extensions picked up from the year folders.
+EXCEL_EXTENSIONS = {'.xlsx', '.xlsb', '.xls'}
+
+def premium_datatypes(premiums):
+    """
+    Returns the datatype of each premium as a categorical.
+    A homogeneous column reports its dtype once; an object column (e.g. text premiums)
+    reports the type name of every value.
+    """
+    if premiums.dtype != object:
+        return pd.Categorical.from_codes(np.zeros(len(premiums), dtype=np.int8), [premiums.dtype.name])
+    values = premiums.to_numpy()
+    return pd.Categorical(np.fromiter((type(v).__name__ for v in values), dtype='U16', count=len(values)))
+
+def key_hashes(df, keys):
+    """Hashes the key columns of each row into a single uint64 join key."""
+    return pd.util.hash_pandas_object(df[keys], index=False).to_numpy()
+
 class FileHandler:
     """Handles file reading for CSV and Excel files."""
-    def read_csv(self, file_path):
-        return pd.read_csv(file_path)
+    def __init__(self):
+        # Opened workbooks keyed by path, so each file is only parsed once.
+        self._excel_cache = {}
     
-    def read_excel(self, file_path, sheet_name=None, header=0, nrows=None):
-        ext = os.path.splitext(file_path)[1].lower()
-        if ext == '.xlsb':
-            return pd.read_excel(file_path, sheet_name=sheet_name, header=header, nrows=nrows, engine='pyxlsb')
-        else:
-            return pd.read_excel(file_path, sheet_name=sheet_name, header=header, nrows=nrows)
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        """Closes every cached workbook."""
+        for excel_file in self._excel_cache.values():
+            excel_file.close()
+        self._excel_cache.clear()
+    
+    def read_csv(self, file_path, usecols=None, dtype=None):
+        return pd.read_csv(file_path, usecols=usecols, dtype=dtype)
+    
+    def read_excel(self, file_path, sheet_name=None, header=0, nrows=None, usecols=None, dtype=None):
+        return self.open_workbook(file_path).parse(sheet_name=sheet_name, header=header, nrows=nrows,
+                                                   usecols=usecols, dtype=dtype)
+    
+    def open_workbook(self, file_path):
+        """Returns the cached workbook for file_path, opening it on first use."""
+        if file_path not in self._excel_cache:
+            # calamine parses .xlsx, .xlsb and .xls natively in Rust.
+            self._excel_cache[file_path] = pd.ExcelFile(file_path, engine='calamine')
+        return self._excel_cache[file_path]
     
     def get_excel_sheet_names(self, file_path):
-        ext = os.path.splitext(file_path)[1].lower()
-        if ext == '.xlsb':
-            return pd.ExcelFile(file_path, engine='pyxlsb').sheet_names
-        else:
-            return pd.ExcelFile(file_path).sheet_names
+        return self.open_workbook(file_path).sheet_names
 
 class DataExtractor:
     """Extracts data from insurer spreadsheets."""
     def extract_sheet_data(self, file_handler, file_path, sheet_name, year, insurer):
         # Read the first 5 rows without header to find the header row
         sample_df = file_handler.read_excel(file_path, sheet_name=sheet_name, header=None, nrows=5)
+        sample_rows = list(sample_df.itertuples(index=False, name=None))
         header_row_index = None
         # Look for a row containing both 'Total premium' and 'Policy number' (case-insensitive)
-        for i in range(len(sample_df)):
-            row_str = ' '.join(sample_df.iloc[i].astype(str).str.lower())
+        for i, row in enumerate(sample_rows):
+            row_str = ' '.join(str(c).lower() for c in row)
             if 'total premium' in row_str and 'policy number' in row_str:
                 header_row_index = i
                 break
         # If not found, default to row 0.
         if header_row_index is None:
             header_row_index = 0
+        header_row = sample_rows[header_row_index] if sample_rows else ()
 
-        # Load the entire sheet using the discovered header row.
-        df = file_handler.read_excel(file_path, sheet_name=sheet_name, header=header_row_index)
-        df.columns = df.columns.str.strip().str.lower()
-        
-        # Verify required columns.
-        if 'policy number' not in df.columns or 'total premium' not in df.columns:
+        # Verify required columns, keeping their names as written in the header row.
+        header_names = {c.strip().lower(): c for c in header_row if isinstance(c, str)}
+        if 'policy number' not in header_names or 'total premium' not in header_names:
             return None
+        policy_col = header_names['policy number']
+        premium_col = header_names['total premium']
+
+        # Load only the required columns of the sheet using the discovered header row.
+        # The premium dtype is inferred so that text premiums are kept and show up in Datatype.
+        df = file_handler.read_excel(file_path, sheet_name=sheet_name, header=header_row_index,
+                                     usecols=[policy_col, premium_col],
+                                     dtype={policy_col: 'string'})
+        df.columns = [c.strip().lower() if isinstance(c, str) else c for c in df.columns]
         
-        # Build the extracted dataframe.
-        extracted = pd.DataFrame({
-            'Year': year,
-            'Insurer': insurer,
-            'Type': sheet_name.lower(),  # Use sheet name as type (in lowercase)
-            'Policy number': df['policy number'],
-            'Premium': df['total premium']
-        })
-        # Record the datatype of the Total premium column.
-        extracted['Datatype'] = df['total premium'].apply(lambda x: type(x).__name__)
-        
-        return extracted
+        # Collect the extracted columns; the DataFrame is built once per file.
+        n_rows = len(df)
+        return {
+            'Year': np.full(n_rows, year),
+            'Insurer': np.full(n_rows, insurer),
+            'Type': np.full(n_rows, sheet_name.lower()),  # Use sheet name as type (in lowercase)
+            'Policy number': df['policy number'].to_numpy(),
+            'Premium': df['total premium'].to_numpy(),
+            # Record the datatype of the Total premium values.
+            'Datatype': premium_datatypes(df['total premium']),
+        }
 
-    def extract_data_from_file(self, file_handler, file_path, year):
+    def extract_data_from_file(self, file_handler, file_path, year, insurer=None):
         """Processes an Excel file, extracting data from sheets starting with 'base' or 'reward'."""
-        insurer = os.path.splitext(os.path.basename(file_path))[0]
+        if insurer is None:
+            insurer = os.path.splitext(os.path.basename(file_path))[0]
         sheet_names = file_handler.get_excel_sheet_names(file_path)
-        extracted_frames = []
+        # Sheets are read sequentially from the one cached handle; files are already spread across processes.
+        extracted_sheets = []
         for sheet in sheet_names:
-            if sheet.lower().startswith('base') or sheet.lower().startswith('reward'):
-                df_sheet = self.extract_sheet_data(file_handler, file_path, sheet, year, insurer)
-                if df_sheet is not None:
-                    extracted_frames.append(df_sheet)
-        if extracted_frames:
-            return pd.concat(extracted_frames, ignore_index=True)
+            if sheet.lower().startswith(('base', 'reward')):
+                sheet_data = self.extract_sheet_data(file_handler, file_path, sheet, year, insurer)
+                if sheet_data is not None:
+                    extracted_sheets.append(sheet_data)
+        if extracted_sheets:
+            extracted = pd.DataFrame({
+                col: np.concatenate([sheet_data[col] for sheet_data in extracted_sheets])
+                for col in extracted_sheets[0] if col != 'Datatype'
+            })
+            # Store the key columns as Arrow-backed strings so string ops run in vectorized kernels.
+            for col in ['Insurer', 'Type', 'Policy number']:
+                extracted[col] = extracted[col].astype('string[pyarrow]')
+            # Combine the per-sheet categoricals by recoding their integer codes.
+            extracted['Datatype'] = pd.api.types.union_categoricals(
+                [sheet_data['Datatype'] for sheet_data in extracted_sheets])
+            return extracted
         else:
             return pd.DataFrame()  # Return empty DataFrame if no valid sheet data is found
 
@@ -81,75 +141,86 @@ class DataComparer:
         into a single 'base' (or 'reward') row per Year, Insurer, and Policy number.
         """
         # Standardize column names to lowercase.
-        given_df.columns = given_df.columns.str.strip().str.lower()
+        given_df.columns = [c.strip().lower() if isinstance(c, str) else c for c in given_df.columns]
         # Create an aggregation key: if type starts with 'base' then set as 'base'; if 'reward', then 'reward'
-        given_df['agg_type'] = given_df['type'].apply(lambda x: 'base' if x.startswith('base') else ('reward' if x.startswith('reward') else x))
-        # Group by year, insurer, aggregated type, and policy number, summing the Premium.
-        agg_df = given_df.groupby(['year', 'insurer', 'agg_type', 'policy number'], as_index=False).agg({'premium': 'sum'})
+        types = given_df['type'].astype('string[pyarrow]')
+        is_base = types.str.startswith('base')
+        is_reward = types.str.startswith('reward')
+        given_df['agg_type'] = np.where(is_base, 'base', np.where(is_reward, 'reward', types))
+        # Encode the group keys as categoricals so grouping hashes integer codes rather than strings.
+        for col in ['insurer', 'agg_type', 'policy number']:
+            given_df[col] = given_df[col].astype('category')
+        given_df['year'] = given_df['year'].astype('int32')
+        # Group by year, insurer, aggregated type, and policy number, summing the Premium into 'given_premium'.
+        agg_df = given_df.groupby(['year', 'insurer', 'agg_type', 'policy number'],
+                                  as_index=False, observed=True, sort=False).agg(given_premium=('premium', 'sum'))
         # Record the datatype of the aggregated premium.
-        agg_df['datatype'] = agg_df['premium'].apply(lambda x: type(x).__name__)
+        agg_df['datatype'] = premium_datatypes(agg_df['given_premium'])
         # Rename the aggregated type column back to 'type'.
         agg_df.rename(columns={'agg_type': 'type'}, inplace=True)
         return agg_df
     
     def compare_data(self, s3_df, given_df):
         # Standardize S3 dataframe column names.
-        s3_df.columns = s3_df.columns.str.strip().str.lower()
-
-        # Rename the premium column in s3_df from 'total premium' to 'premium'
-        s3_df.rename(columns={'total premium': 'premium'}, inplace=True)
+        s3_df.columns = [c.strip().lower() if isinstance(c, str) else c for c in s3_df.columns]
+        # Name the S3 premium column so the comparison needs no merge suffixes.
+        s3_df.rename(columns={'total premium': 's3_premium'}, inplace=True)
         
         # Aggregate Given premium data to consolidate sub-type sheets.
         aggregated_given_df = self.aggregate_given_data(given_df)
 
-        print(s3_df.columns)
-        print(aggregated_given_df.columns)
+        logger.debug("S3 columns: %s", list(s3_df.columns))
+        logger.debug("Given columns: %s", list(aggregated_given_df.columns))
 
         # Standardize key columns in both DataFrames:
         for col in ['insurer', 'type', 'policy number']:
-            s3_df[col] = s3_df[col].astype(str).str.strip().str.lower()
+            s3_df[col] = s3_df[col].astype('string[pyarrow]').str.strip().str.lower()
 
         s3_df['year'] = s3_df['year'].astype(int)  # Convert to int
         aggregated_given_df['year'] = aggregated_given_df['year'].astype(int)  # Convert to int
 
-        # Merge S3 and aggregated Given data on year, insurer, type, and policy number.
-        merged = pd.merge(s3_df, aggregated_given_df, on=['year', 'insurer', 'type', 'policy number'],
-                          how='outer', suffixes=('_s3', '_given'))
-        
-        def determine_status(row):
-            s3_premium = row.get('total premium')
-            given_premium = row.get('premium')
-            if pd.isnull(s3_premium) and not pd.isnull(given_premium):
-                return "Missing in S3"
-            elif pd.isnull(given_premium) and not pd.isnull(s3_premium):
-                return "Missing in Given"
-            elif pd.isnull(s3_premium) and pd.isnull(given_premium):
-                return "Both Missing"
-            elif s3_premium == given_premium:
-                return "Matches"
-            else:
-                return "Not matches"
-        
-        merged['Status'] = merged.apply(determine_status, axis=1)
-
-        print("merged df:", merged)
+        # Outer-align S3 and aggregated Given data on year, insurer, type, and policy number.
+        # The four key columns are hashed into one uint64 per row so lookups probe a single integer key.
+        keys = ['year', 'insurer', 'type', 'policy number']
+        s3_hashes = key_hashes(s3_df, keys)
+        given_hashes = key_hashes(aggregated_given_df, keys)
+        given_indexed = aggregated_given_df.set_index(pd.Index(given_hashes))
+        # Given keys are unique after aggregation; S3 is not aggregated, so every S3 row
+        # (duplicate or blank keys included) is kept and looks up its Given premium by hash.
+        s3_rows = s3_df[keys].reset_index(drop=True)
+        s3_rows['S3_premium'] = s3_df['s3_premium'].to_numpy()
+        s3_rows['Given_premium'] = given_indexed['given_premium'].reindex(s3_hashes).to_numpy()
+        s3_rows['datatype'] = given_indexed['datatype'].reindex(s3_hashes).array
+        # Given keys that do not occur in S3 are appended with no S3 premium.
+        given_only = aggregated_given_df[~pd.Index(given_hashes).isin(s3_hashes)]
+        given_rows = given_only[keys].reset_index(drop=True)
+        given_rows['S3_premium'] = np.nan
+        given_rows['Given_premium'] = given_only['given_premium'].to_numpy()
+        given_rows['datatype'] = given_only['datatype'].array
+        # Skip an empty side so it does not take part in the result dtypes.
+        non_empty = [rows for rows in (s3_rows, given_rows) if len(rows)] or [s3_rows]
+        merged = pd.concat(non_empty, ignore_index=True, copy=False)
         
-        def record_multivalues(row):
-            if row['Status'] == "Not matches":
-                return f"[{row.get('total premium')}, {row.get('premium')}]"
-            else:
-                return ""
+        # Determine the comparison status for every row at once.
+        s3_premium = merged['S3_premium']
+        given_premium = merged['Given_premium']
+        s3_missing = s3_premium.isna()
+        given_missing = given_premium.isna()
+        conditions = [
+            s3_missing & ~given_missing,
+            ~s3_missing & given_missing,
+            s3_missing & given_missing,
+            s3_premium == given_premium,
+        ]
+        choices = ["Missing in S3", "Missing in Given", "Both Missing", "Matches"]
+        merged['Status'] = np.select(conditions, choices, default="Not matches")
         
-        merged['Multivalues'] = merged.apply(record_multivalues, axis=1)
+        # Record both premiums side by side where they do not match.
+        not_matches = merged['Status'].values == "Not matches"
+        formatted = "[" + s3_premium.astype(str) + ", " + given_premium.astype(str) + "]"
+        merged['Multivalues'] = np.where(not_matches, formatted, "")
 
-        print("merged df:", merged)
-        # Rename columns for clarity.
-        merged.rename(columns={
-            'premium_s3': 'S3_premium',
-            'premium_given': 'Given_premium'
-        }, inplace=True)
-
-        print("merged df:", merged)
+        logger.debug("merged shape=%s", merged.shape)
         # Rearranging the columns as specified.
         cols = ['year', 'insurer', 'type', 'policy number', 'S3_premium', 'Given_premium', 'datatype', 'Status', 'Multivalues']
         comparison_df = merged[cols]
@@ -164,39 +235,57 @@ class DataComparer:
         return comparison_df
 
 class ReportGenerator:
-    """Generates Excel reports for Given premium data and comparison report."""
+    """Generates Excel (and Parquet) reports for Given premium data and comparison report."""
     def save_given_premium(self, given_df, output_path):
-        given_df.to_excel(output_path, index=False)
+        given_df.to_excel(output_path, index=False, engine='xlsxwriter')
+        self.save_parquet(given_df, os.path.splitext(output_path)[0] + '.parquet')
     
     def save_comparison_report(self, comparison_df, output_path):
-        comparison_df.to_excel(output_path, index=False)
+        comparison_df.to_excel(output_path, index=False, engine='xlsxwriter')
+        self.save_parquet(comparison_df, os.path.splitext(output_path)[0] + '.parquet')
         print(f"Comparison report saved to {output_path}")
+    
+    def save_parquet(self, df, output_path):
+        """Saves a report as Parquet, which is much faster to write and read back than Excel."""
+        # Parquet columns need a single type, so mixed object columns (e.g. text premiums) are stored as strings.
+        mixed_cols = [col for col in df.columns if df[col].dtype == object]
+        if mixed_cols:
+            df = df.astype({col: 'string' for col in mixed_cols})
+        df.to_parquet(output_path, engine='pyarrow', compression='zstd', index=False)
+
+def process_file(file_path, year, insurer=None):
+    """Extracts Given premium data from one workbook (module-level so it can run in a worker process)."""
+    with FileHandler() as file_handler:
+        return DataExtractor().extract_data_from_file(file_handler, file_path, year, insurer)
 
 def main(root_folder, s3_excel_path, given_output_path, comparison_output_path):
-    file_handler = FileHandler()
-    data_extractor = DataExtractor()
     data_comparer = DataComparer()
     report_generator = ReportGenerator()
     
     # Read S3 premium data from CSV.
-    s3_df = file_handler.read_excel(s3_excel_path, sheet_name='Sheet1')
-    s3_df.columns = s3_df.columns.str.strip().str.lower()
-    
-    all_given_data = []   # List because we may have multiple Given premium dataframes to concatenate.
-    # Iterate through each year folder.
-    for year_folder in os.listdir(root_folder):
-        year_folder_path = os.path.join(root_folder, year_folder)
-        if os.path.isdir(year_folder_path):
-            # Process each Excel file in the year folder.
-            for file in os.listdir(year_folder_path):
-                if file.lower().endswith(('.xlsx', '.xlsb', '.xls')):
-                    file_path = os.path.join(year_folder_path, file)
-                    extracted_data = data_extractor.extract_data_from_file(file_handler, file_path, year_folder)
-                    if not extracted_data.empty:
-                        all_given_data.append(extracted_data)
+    with FileHandler() as file_handler:
+        s3_df = file_handler.read_excel(s3_excel_path, sheet_name='Sheet1',
+                                        usecols=lambda c: isinstance(c, str) and c.strip().lower() in S3_COLUMNS)
+    s3_df.columns = [c.strip().lower() if isinstance(c, str) else c for c in s3_df.columns]
+    
+    # Each workbook is independent, so parse them in parallel worker processes.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        # Iterate through each year folder.
+        for year_entry in os.scandir(root_folder):
+            if year_entry.is_dir():
+                # Process each Excel file in the year folder.
+                for file_entry in os.scandir(year_entry.path):
+                    # Split the file name once; the stem is the insurer name.
+                    insurer, ext = os.path.splitext(file_entry.name)
+                    if ext.lower() in EXCEL_EXTENSIONS:
+                        futures.append(executor.submit(process_file, file_entry.path, year_entry.name, insurer))
+        # Collect in submission order so the Given report is deterministic.
+        extracted = (future.result() for future in futures)
+        all_given_data = [extracted_data for extracted_data in extracted if not extracted_data.empty]
     
     if all_given_data:
-        given_df = pd.concat(all_given_data, ignore_index=True)
+        given_df = pd.concat(all_given_data, ignore_index=True, copy=False)
     else:
         given_df = pd.DataFrame()
     